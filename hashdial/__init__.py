@@ -25,31 +25,118 @@ For example, filtering to keep 1% of lines in a file followed by applying the sa
 change in output relative to just filtering once - since line that was kept the first time will also be kept the
 second time.
 
+Performance
+-----------
+
+The library is pure Python; hashing is done by :mod:`hashlib`. For the short keys it is typically used with, the
+cost of a call is dominated by interpreter overhead rather than by hashing. When deciding for many keys at once,
+prefer the batch functions (such as :func:`decide_many`) which validate their arguments once rather than per key.
+
 Determinism across versions
 ---------------------------
 
 Any change to an existing function (including default seed and choice of hashing algorithm) that would alter the
 output of the function given the same input, will not be done without a major version bump to the library.
 
+All functions hash the seed followed by the key using SHA-256, and interpret the first 8 bytes of the digest as a
+big-endian unsigned integer. Faster hashes such as BLAKE3 or xxHash would change every output, and so are not used
+within this major version.
+
 API
 ---
 """
+import builtins
+import concurrent.futures
+import functools
 import hashlib
-import math
+import os
 import sys
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Sequence
+from typing import Tuple  # noqa (mypy/lint fight)
 from typing import TypeVar
+from typing import Union
 
 DEFAULT_SEED = b""
 
 _MAX_FLOAT_REPRESENTABLE_INT = 2 ** (sys.float_info.mant_dig) - 1
 
+# Hash values are the first 8 bytes of the digest, so they are in range [0, _TWO_64).
+_TWO_64 = 2 ** 64
+
+# Multiplying by this is exact (it is a power of two), so it gives the same result as dividing by _TWO_64.
+_INV_2_64 = 1.0 / _TWO_64
+
+# The widest range range() can map a 64-bit hash onto.
+_MAX_RANGE_SIZE = _TWO_64
+
+# Seeds at least this long fill a complete SHA-256 block, which can be compressed once and reused across keys.
+_SHA256_BLOCK_SIZE = 64
+
+
+@functools.lru_cache(maxsize=32)
+def _seeded_sha256(seed: bytes) -> "hashlib._Hash":
+    # Must not be updated by callers; copy() it instead.
+    return hashlib.sha256(seed)
+
+
+def _hash_u64(
+    b: Union[bytes, bytearray, memoryview], seed: Union[bytes, bytearray, memoryview]
+) -> int:
+    if len(seed) >= _SHA256_BLOCK_SIZE:
+        # The cache needs a hashable seed. bytes() of a bytes object returns the object itself, so this copies only
+        # other bytes-like seeds (such as a bytearray).
+        h = _seeded_sha256(bytes(seed)).copy()
+        h.update(b)
+        digest = h.digest()
+    else:
+        # Hashing the concatenation in one call is equivalent to two update() calls, but avoids the per-call overhead
+        # of driving a hash object from Python (which dominates for the short keys this library is typically used
+        # with). join() rather than + since, unlike +, it accepts any bytes-like seed (including a memoryview).
+        digest = hashlib.sha256(b"".join((seed, b))).digest()
+    return int.from_bytes(digest[:8], "big")
+
 
 def _hfloat(b: bytes, seed: bytes) -> float:
-    h = hashlib.sha256()
-    h.update(seed)
-    h.update(b)
-    return float(int(h.hexdigest()[0:16], 16)) / 2 ** 64
+    # Hot paths inline this rather than paying for the extra call.
+    return _hash_u64(b, seed) * _INV_2_64
+
+
+def _validate_probability(probability: float) -> None:
+    # A single chained comparison on the common (valid) path. NaN fails it but is, as before, not rejected below.
+    if not 0.0 <= probability <= 1.0:
+        if probability < 0.0:
+            raise ValueError("probability ({}) must be >= 0.0".format(probability))
+        if probability > 1.0:
+            raise ValueError("probability ({}) must be <= 1.0".format(probability))
+
+
+def _u64_threshold(probability: float) -> int:
+    # The smallest hash value for which decide() returns False, i.e. the smallest u such that u * _INV_2_64 is not <
+    # probability. Found by bisection over the same float expression decide() evaluates, so that comparing hash values
+    # against it gives exactly the same decisions even where the conversion of a hash value to float rounds.
+    lo, hi = 0, _TWO_64
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mid * _INV_2_64 < probability:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _validate_range(stop: int, start: int) -> None:
+    if stop <= start:
+        raise ValueError("stop ({}) must be > start ({})".format(stop, start))
+
+    if stop - start > _MAX_RANGE_SIZE:
+        raise ValueError(
+            "stop-start ({}) must be <= {}".format(stop - start, _MAX_RANGE_SIZE)
+        )
 
 
 def decide(key: bytes, probability: float, *, seed: bytes = DEFAULT_SEED) -> bool:
@@ -69,12 +156,219 @@ def decide(key: bytes, probability: float, *, seed: bytes = DEFAULT_SEED) -> boo
 
     :return: Whether to take the action.
     """
-    if probability < 0.0:
-        raise ValueError("probability ({}) must be >= 0.0".format(probability))
-    if probability > 1.0:
-        raise ValueError("probability ({}) must be <= 1.0".format(probability))
+    _validate_probability(probability)
+
+    return _hash_u64(key, seed) * _INV_2_64 < probability
+
+
+def decide_many(
+    keys: Iterable[Union[bytes, bytearray, memoryview]],
+    probability: float,
+    *,
+    seed: bytes = DEFAULT_SEED
+) -> List[bool]:
+    """
+    Equivalent to calling :func:`decide` for each of ``keys``, but cheaper when deciding for many keys at once since
+    ``probability`` is validated only once.
+
+    For example, to retain 25% of lines read from stdin::
+
+        lines = sys.stdin.buffer.readlines()
+        for line, keep in zip(lines, decide_many(lines, 0.25)):
+            if keep:
+                sys.stdout.buffer.write(line)
 
-    return _hfloat(key, seed) < probability
+    Keys may be any bytes-like object. Fixed-width keys stored back to back in a single buffer (such as the rows of a
+    2-D ``uint8`` NumPy array) can be passed as slices of a :class:`memoryview`, avoiding a copy per key::
+
+        view = memoryview(buf)
+        decisions = decide_many((view[i:i + width] for i in range(0, len(view), width)), 0.25)
+
+    :param keys: The keys to hash.
+    :param probability: The probability of a given key being decided ``True``. Must be in range [0, 1].
+    :param seed: Seed to hash prior to hashing each key.
+
+    :return: The decision for each key, in the order of ``keys``.
+    """
+    _validate_probability(probability)
+
+    return [_hash_u64(key, seed) * _INV_2_64 < probability for key in keys]
+
+
+def decide_parallel(
+    keys: Sequence[bytes],
+    probability: float,
+    *,
+    seed: bytes = DEFAULT_SEED,
+    workers: Optional[int] = None,
+    chunk_size: int = 10000
+) -> List[bool]:
+    """
+    Equivalent to :func:`decide_many`, but spreads the work over multiple processes.
+
+    Worker processes rather than threads are used, since hashing keys as short as those this library is typically used
+    with does not release the GIL. Each chunk of keys must be sent to a worker and its decisions sent back, so this
+    only pays off for large numbers of keys on machines with several cores. With a single worker (as by default on a
+    machine with a single CPU) the keys are instead decided in the calling process, as by :func:`decide_many`.
+
+    As with any use of :class:`concurrent.futures.ProcessPoolExecutor`, on platforms where worker processes are
+    started by spawning a new interpreter (such as Windows and macOS) the calling script must guard its entry point
+    with ``if __name__ == "__main__":``.
+
+    :param keys: The keys to hash.
+    :param probability: The probability of a given key being decided ``True``. Must be in range [0, 1].
+    :param seed: Seed to hash prior to hashing each key.
+    :param workers: The maximum number of worker processes. Must be positive. Defaults to the number of CPUs.
+    :param chunk_size: The number of keys handed to a worker at a time. Must be positive.
+
+    :return: The decision for each key, in the order of ``keys``.
+    """
+    _validate_probability(probability)
+    if chunk_size <= 0:
+        raise ValueError("chunk_size ({}) must be > 0".format(chunk_size))
+    if workers is not None and workers <= 0:
+        raise ValueError("workers ({}) must be > 0".format(workers))
+
+    if len(keys) <= chunk_size or (workers or os.cpu_count() or 1) == 1:
+        return decide_many(keys, probability, seed=seed)
+
+    decide_chunk = functools.partial(decide_many, probability=probability, seed=seed)
+    chunks = (
+        keys[offset : offset + chunk_size]
+        for offset in builtins.range(0, len(keys), chunk_size)
+    )
+    decisions = []  # type: List[bool]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for chunk_decisions in executor.map(decide_chunk, chunks):
+            decisions.extend(chunk_decisions)
+
+    return decisions
+
+
+def decide_fixed_width(
+    buf: bytes, width: int, probability: float, *, seed: bytes = DEFAULT_SEED
+) -> bytes:
+    """
+    Decide for each of the keys of ``width`` bytes stored back to back in ``buf``, as :func:`decide` would, and return
+    the decisions as a bitmap.
+
+    The decision for the key at index ``i`` (starting at byte ``i * width`` of ``buf``) is bit ``i % 8`` (counting
+    from the least significant bit) of byte ``i // 8`` of the result. Bits past the last key are zero.
+
+    For example, with keys that are 16 byte UUIDs::
+
+        bitmap = decide_fixed_width(b''.join(u.bytes for u in uuids), 16, 0.25)
+        kept = [u for i, u in enumerate(uuids) if bitmap[i // 8] >> (i % 8) & 1]
+
+    :param buf: The keys to hash, concatenated.
+    :param width: The length of each key. Must be positive, and divide the length of ``buf``.
+    :param probability: The probability of a given key being decided ``True``. Must be in range [0, 1].
+    :param seed: Seed to hash prior to hashing each key.
+
+    :raise ValueError: If ``width`` is not positive or the length of ``buf`` is not a multiple of it.
+
+    :return: The decisions, one bit per key.
+    """
+    _validate_probability(probability)
+    if width <= 0:
+        raise ValueError("width ({}) must be > 0".format(width))
+    if len(buf) % width:
+        raise ValueError(
+            "buffer length ({}) must be a multiple of width ({})".format(
+                len(buf), width
+            )
+        )
+
+    threshold = _u64_threshold(probability)
+    bitmap = bytearray((len(buf) // width + 7) // 8)
+    # For short keys, copying each one out of buf is cheaper than hashing memoryview slices of it.
+    for i, offset in enumerate(builtins.range(0, len(buf), width)):
+        end = offset + width
+        if _hash_u64(buf[offset:end], seed) < threshold:
+            bitmap[i >> 3] |= 1 << (i & 7)
+
+    return bytes(bitmap)
+
+
+def make_decider(
+    probability: float, *, seed: bytes = DEFAULT_SEED, cache_bits: int = 0
+) -> Callable[[Union[bytes, bytearray, memoryview]], bool]:
+    """
+    Return a function equivalent to ``lambda key: decide(key, probability, seed=seed)``, for repeated decisions with
+    the same ``probability`` and ``seed``.
+
+    ``probability`` is validated once and turned into an integer threshold that hash values are compared against
+    directly, rather than doing so on every call.
+
+    For example, to retain 25% of lines read from stdin::
+
+        keep = make_decider(0.25)
+        for line in sys.stdin:
+            if keep(line.encode('utf-8')):
+                sys.stdout.write(line)
+
+    If the same keys tend to recur close together, ``cache_bits`` can be used to remember recent decisions in a
+    direct-mapped cache of ``2 ** cache_bits`` entries, indexed by the built-in :func:`hash` of the key. A cache hit
+    avoids hashing the key with SHA-256, but every call pays for the lookup, so this only helps when a substantial
+    fraction of calls are for recently seen keys. Keys that are not :class:`bytes` bypass the cache.
+
+    :param probability: The probability of a given key being decided ``True``. Must be in range [0, 1].
+    :param seed: Seed to hash prior to hashing each key.
+    :param cache_bits: The log2 of the number of cached decisions. ``0`` (the default) disables caching.
+
+    :return: A function taking a key and returning whether to take the action.
+    """
+    _validate_probability(probability)
+    if cache_bits < 0:
+        raise ValueError("cache_bits ({}) must be >= 0".format(cache_bits))
+    threshold = _u64_threshold(probability)
+
+    def decider(key: Union[bytes, bytearray, memoryview]) -> bool:
+        return _hash_u64(key, seed) < threshold
+
+    if not cache_bits:
+        return decider
+
+    mask = (1 << cache_bits) - 1
+    # Entries are (key, decision) tuples so that each is replaced with a single store, and concurrent callers can
+    # never observe a key paired with another key's decision.
+    cache = [None] * (mask + 1)  # type: List[Optional[Tuple[object, bool]]]
+
+    def caching_decider(key: Union[bytes, bytearray, memoryview]) -> bool:
+        if type(key) is not bytes:
+            # Other bytes-like keys may not be hashable (such as a bytearray or a writable memoryview), and a cached
+            # memoryview would keep its whole underlying buffer alive.
+            return _hash_u64(key, seed) < threshold
+
+        slot = hash(key) & mask
+        entry = cache[slot]
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        decision = _hash_u64(key, seed) < threshold
+        cache[slot] = (key, decision)
+        return decision
+
+    return caching_decider
+
+
+def filter_lines(
+    lines: Iterable[bytes], probability: float, *, seed: bytes = DEFAULT_SEED
+) -> Iterator[bytes]:
+    """
+    Filter ``lines``, keeping those for which :func:`decide` returns ``True``.
+
+    Each line is hashed as-is (including any trailing newline). For example, to retain 25% of lines read from stdin::
+
+        sys.stdout.buffer.writelines(filter_lines(sys.stdin.buffer, 0.25))
+
+    :param lines: The lines to filter.
+    :param probability: The probability of a given line being kept. Must be in range [0, 1].
+    :param seed: Seed to hash prior to hashing each line.
+
+    :return: An iterator over the kept lines, in their original order.
+    """
+    return builtins.filter(make_decider(probability, seed=seed), lines)
 
 
 def range(key: bytes, stop: int, *, start: int = 0, seed: bytes = DEFAULT_SEED) -> int:
@@ -87,8 +381,9 @@ def range(key: bytes, stop: int, *, start: int = 0, seed: bytes = DEFAULT_SEED)
             if range(line.encode('utf-8'), 10) == 3:
                 sys.stdout.write(line)
 
-    The difference between stop and start must be sufficiently small to be exactly representable as a
-    float (no larger than ``2**(sys.float_info.mant_dig) - 1``).
+    The difference between stop and start must be no larger than ``2 ** 64``. For ranges wider than
+    ``2 ** (sys.float_info.mant_dig) - 1`` the hash is scaled using integer rather than floating point arithmetic, so
+    that every integer in the range can be selected.
 
     :param key: The bytes to hash.
     :param stop: The *exclusive* end of the range of integers among which to select.
@@ -97,16 +392,38 @@ def range(key: bytes, stop: int, *, start: int = 0, seed: bytes = DEFAULT_SEED)
 
     :return: The selected integer.
     """
-    if stop <= start:
-        raise ValueError("stop ({}) must be > start ({})".format(stop, start))
+    _validate_range(stop, start)
 
-    if stop - start > _MAX_FLOAT_REPRESENTABLE_INT:
-        raise ValueError(
-            "stop-start must be <= {} due to limitations of floats",
-            _MAX_FLOAT_REPRESENTABLE_INT,
-        )
+    size = stop - start
+    if size <= _MAX_FLOAT_REPRESENTABLE_INT:
+        # The scaled hash is non-negative, so truncating it with int() is the same as flooring it.
+        return start + int(size * (_hash_u64(key, seed) * _INV_2_64))
+
+    # Floats cannot represent every integer in a range this wide, so scale the hash using integer arithmetic instead.
+    return start + ((_hash_u64(key, seed) * size) >> 64)
+
+
+def range_many(
+    keys: Iterable[bytes], stop: int, *, start: int = 0, seed: bytes = DEFAULT_SEED
+) -> List[int]:
+    """
+    Equivalent to calling :func:`range` for each of ``keys``, but cheaper when selecting for many keys at once since
+    ``start`` and ``stop`` are validated only once.
+
+    :param keys: The keys to hash.
+    :param stop: The *exclusive* end of the range of integers among which to select.
+    :param start: The *inclusive* start of the range of integers among which to select.
+    :param seed: Seed to hash prior to hashing each key.
+
+    :return: The selected integer for each key, in the order of ``keys``.
+    """
+    _validate_range(stop, start)
+
+    size = stop - start
+    if size <= _MAX_FLOAT_REPRESENTABLE_INT:
+        return [start + int(size * (_hash_u64(key, seed) * _INV_2_64)) for key in keys]
 
-    return int(start + math.floor((stop - start) * _hfloat(key, seed)))
+    return [start + ((_hash_u64(key, seed) * size) >> 64) for key in keys]
 
 
 BucketType = TypeVar("BucketType")
@@ -135,4 +452,84 @@ def select(
     if not seq:
         raise ValueError("non-empty sequence required")
 
-    return seq[range(key, len(seq), seed=seed)]
+    # Equivalent to seq[range(key, len(seq), seed=seed)], without the overhead of the call for the common case.
+    size = len(seq)
+    if size > _MAX_FLOAT_REPRESENTABLE_INT:
+        return seq[range(key, size, seed=seed)]
+
+    return seq[int(size * (_hash_u64(key, seed) * _INV_2_64))]
+
+
+class PreparedSeed:
+    """
+    A seed that has already been hashed, for making many decisions with the same seed. Create one with
+    :func:`prepare`.
+
+    The methods are equivalent to the module level functions of the same name called with the prepared seed, but only
+    hash ``key`` on each call.
+    """
+
+    __slots__ = ("_sha256",)
+
+    def __init__(self, seed: bytes) -> None:
+        # Must not be updated; copy() it instead. Unlike in the module level _hash_u64(), this is used even for short
+        # seeds: hashing seed + key in one call measured slower here than copy(), once the seed has to be fetched from
+        # the instance and concatenated.
+        self._sha256 = hashlib.sha256(seed)
+
+    def _hash_u64(self, key: bytes) -> int:
+        h = self._sha256.copy()
+        h.update(key)
+        return int.from_bytes(h.digest()[:8], "big")
+
+    def decide(self, key: bytes, probability: float) -> bool:
+        """
+        See :func:`hashdial.decide`.
+        """
+        _validate_probability(probability)
+
+        return self._hash_u64(key) * _INV_2_64 < probability
+
+    def range(self, key: bytes, stop: int, *, start: int = 0) -> int:
+        """
+        See :func:`hashdial.range`.
+        """
+        _validate_range(stop, start)
+
+        size = stop - start
+        if size <= _MAX_FLOAT_REPRESENTABLE_INT:
+            return start + int(size * (self._hash_u64(key) * _INV_2_64))
+
+        return start + ((self._hash_u64(key) * size) >> 64)
+
+    def select(self, key: bytes, seq: Sequence[BucketType]) -> BucketType:
+        """
+        See :func:`hashdial.select`.
+        """
+        if not seq:
+            raise ValueError("non-empty sequence required")
+
+        size = len(seq)
+        if size > _MAX_FLOAT_REPRESENTABLE_INT:
+            return seq[self.range(key, size)]
+
+        return seq[int(size * (self._hash_u64(key) * _INV_2_64))]
+
+
+def prepare(seed: bytes) -> PreparedSeed:
+    """
+    Prepare ``seed`` for making many decisions with it.
+
+    Hashing ``seed`` is done once, here, rather than on every call. For example, to retain 25% of lines read from stdin
+    using a secret seed::
+
+        prepared = prepare(secret)
+        for line in sys.stdin:
+            if prepared.decide(line.encode('utf-8'), 0.25):
+                sys.stdout.write(line)
+
+    :param seed: Seed to hash prior to hashing each key.
+
+    :return: The prepared seed.
+    """
+    return PreparedSeed(seed)
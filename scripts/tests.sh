@@ -4,4 +4,6 @@ set -ex
 
 export PYTHONPATH=.
 
-pytest
+# Arguments are passed on to pytest. For example, "scripts/tests.sh -n auto" runs the tests in parallel using
+# pytest-xdist (see requirements-dev.in).
+pytest "$@"
@@ -1,43 +1,111 @@
-from typing import Dict  # noqa (mypy/lint fight)
+import math
+from typing import Callable
+from typing import List
+from typing import Tuple
 
 import pytest
+from _pytest.monkeypatch import MonkeyPatch
 
 import hashdial
 
 
-def test_hfloat_distribution() -> None:
-    NUM_SAMPLES = 10000
+@pytest.fixture(scope="session")
+def sample_keys() -> Tuple[bytes, ...]:
+    """
+    Keys for the tests, built once and shared between them. A tuple, so that no test can modify them for the others.
+    """
+    return tuple("{}".format(n).encode("utf-8") for n in range(10000))
+
+
+SAMPLE_KEY_WIDTH = 4
+
+
+@pytest.fixture(scope="session")
+def sample_buffer() -> bytes:
+    """
+    Fixed-width keys for the tests of the buffer based functions, concatenated into one buffer, built once and shared
+    between them.
+    """
+    return b"".join("{:04d}".format(n).encode("utf-8") for n in range(10000))
+
+
+def assert_binomial(count: int, probability: float, num_samples: int) -> None:
+    """
+    Assert that ``count`` is within 5 standard deviations of the expected number of successes in ``num_samples``
+    trials with success probability ``probability``.
+    """
+    expected = probability * num_samples
+    tolerance = 5 * math.sqrt(num_samples * probability * (1 - probability))
+    assert expected - tolerance < count < expected + tolerance
+
+
+def test_hfloat_distribution(sample_keys: Tuple[bytes, ...]) -> None:
+    # This deliberately exercises the real (SHA-256 based) hash rather than a cheaper stand-in: the point is to check
+    # the distribution of what the library actually computes.
+    NUM_SAMPLES = len(sample_keys)
     NUM_BUCKETS = 10
 
-    buckets = {}  # type: Dict[int, int]
-    for n in range(NUM_SAMPLES):
-        f = hashdial._hfloat("{}".format(n).encode("utf-8"), seed=b"")
+    # Bound locally to avoid looking the function up on every iteration.
+    hfloat = hashdial._hfloat
+
+    counts = [0] * NUM_BUCKETS
+    for key in sample_keys:
+        f = hfloat(key, seed=b"")
         assert f >= 0.0
+        # Hash values close to 2 ** 64 round up to 1.0 when converted to float; count those in the last bucket.
         assert f <= 1.0
-        bucket = int(f * NUM_BUCKETS)
-        buckets[bucket] = buckets.get(bucket, 0) + 1
+        counts[min(int(f * NUM_BUCKETS), NUM_BUCKETS - 1)] += 1
 
     # Assert that all buckets are within 10% of target ratio.
-    for _, count in buckets.items():
-        assert count > float(1) / NUM_BUCKETS * NUM_SAMPLES * 0.9
-        assert count < float(1) / NUM_BUCKETS * NUM_SAMPLES * 1.1
+    LOW = NUM_SAMPLES * 0.9 / NUM_BUCKETS
+    HIGH = NUM_SAMPLES * 1.1 / NUM_BUCKETS
+    for count in counts:
+        assert LOW < count < HIGH
+
+    # Pearson's chi-squared test of uniformity across all buckets together. 27.877 is the critical value for 9 degrees
+    # of freedom at a significance level of 0.001.
+    expected = NUM_SAMPLES / NUM_BUCKETS
+    chi_squared = sum((count - expected) ** 2 / expected for count in counts)
+    assert chi_squared < 27.877
 
 
 def test_hfloat_uses_seed() -> None:
     assert hashdial._hfloat(b"t", seed=b"") != hashdial._hfloat(b"t", seed=b"something")
 
 
-def test_decide() -> None:
+def test_hfloat_stable() -> None:
+    # Changing these values requires a major version bump (see "Determinism across versions").
+    assert hashdial._hfloat(b"", seed=b"") == 0.8894159948913374
+    assert hashdial._hfloat(b"hashdial", seed=b"") == 0.10056506191410386
+    assert hashdial._hfloat(b"hashdial", seed=b"seed") == 0.4691070158975641
+    assert hashdial._hfloat(b"x" * 100, seed=b"y" * 70) == 0.10364491406791157
+
+
+def test_hfloat_long_seed() -> None:
+    # Long seeds go through a cached, pre-seeded hash object which must not be affected by earlier keys.
+    seed = b"s" * 100
+    first = hashdial._hfloat(b"a", seed=seed)
+    hashdial._hfloat(b"b", seed=seed)
+    assert hashdial._hfloat(b"a", seed=seed) == first
+    assert first == hashdial._hfloat(seed[50:] + b"a", seed=seed[:50])
+
+
+def test_hash_u64_bytes_like_seed() -> None:
+    for seed in [b"seed", b"s" * 100]:
+        first = hashdial._hash_u64(b"a", seed=seed)
+        assert hashdial._hash_u64(b"a", seed=bytearray(seed)) == first
+        assert hashdial._hash_u64(b"a", seed=memoryview(seed)) == first
+
+
+def test_decide(sample_keys: Tuple[bytes, ...]) -> None:
     PROBABILITY = 0.25
     NUM_SAMPLES = 1000
 
-    value_count = {}  # type: Dict[bool,int]
-    for n in range(NUM_SAMPLES):
-        b = hashdial.decide("{}".format(n).encode("utf-8"), PROBABILITY)
-        value_count[b] = value_count.get(b, 0) + 1
+    keys = sample_keys[:NUM_SAMPLES]
 
-    assert value_count[True] > PROBABILITY * NUM_SAMPLES * 0.9
-    assert value_count[True] < PROBABILITY * NUM_SAMPLES * 1.1
+    num_true = sum(hashdial.decide(key, PROBABILITY) for key in keys)
+
+    assert PROBABILITY * NUM_SAMPLES * 0.9 < num_true < PROBABILITY * NUM_SAMPLES * 1.1
 
 
 def test_decide_bad_probability() -> None:
@@ -56,53 +124,290 @@ def test_decide_seed() -> None:
     assert hashdial.decide(b"t", 0.5) != hashdial.decide(b"t", 0.5, seed=b"test2")
 
 
-def test_range_distribution() -> None:
-    NUM_SAMPLES = 10000
+def test_decide_many(sample_keys: Tuple[bytes, ...]) -> None:
+    keys = sample_keys[:1000]
 
-    values = {}  # type: Dict[int, int]
+    assert hashdial.decide_many(keys, 0.25) == [
+        hashdial.decide(key, 0.25) for key in keys
+    ]
+    assert hashdial.decide_many(keys, 0.25, seed=b"test2") == [
+        hashdial.decide(key, 0.25, seed=b"test2") for key in keys
+    ]
+    assert hashdial.decide_many([], 0.25) == []
 
-    for n in range(NUM_SAMPLES):
-        selected = hashdial.range("{}".format(n).encode("utf-8"), 2, start=-1)
-        values[selected] = values.get(selected, 0) + 1
+    with pytest.raises(ValueError):
+        hashdial.decide_many(keys, 1.5)
 
-    assert set(values.keys()) == {-1, 0, 1}
 
-    for val in [-1, 0, 1]:
-        assert values[val] > NUM_SAMPLES * 0.33 * 0.9
-        assert values[val] < NUM_SAMPLES * 0.33 * 1.1
+def test_decide_many_buffer_keys(sample_buffer: bytes) -> None:
+    WIDTH = SAMPLE_KEY_WIDTH
+    view = memoryview(sample_buffer)[: 1000 * WIDTH]
+    views = [view[offset : offset + WIDTH] for offset in range(0, len(view), WIDTH)]
+    keys = [bytes(v) for v in views]
 
+    for seed in [b"", b"s" * 100]:
+        assert hashdial.decide_many(views, 0.25, seed=seed) == hashdial.decide_many(
+            keys, 0.25, seed=seed
+        )
 
-def test_range_seed() -> None:
-    assert hashdial.range(b"t", 2) != hashdial.range(b"t", 2, seed=b"test2")
 
+def test_decide_parallel(sample_keys: Tuple[bytes, ...]) -> None:
+    keys = sample_keys[:1000]
+
+    assert hashdial.decide_parallel(
+        keys, 0.25, seed=b"test2", workers=2, chunk_size=300
+    ) == hashdial.decide_many(keys, 0.25, seed=b"test2")
+    assert hashdial.decide_parallel(keys, 0.25) == hashdial.decide_many(keys, 0.25)
+
+    with pytest.raises(ValueError):
+        hashdial.decide_parallel(keys, 1.5)
+    with pytest.raises(ValueError):
+        hashdial.decide_parallel(keys, 0.25, chunk_size=0)
+    with pytest.raises(ValueError) as exc_info:
+        hashdial.decide_parallel(keys, 0.25, workers=0)
+    assert str(exc_info.value) == "workers (0) must be > 0"
+    with pytest.raises(ValueError):
+        hashdial.decide_parallel(keys, 0.25, workers=-1)
+
+
+def test_decide_parallel_single_cpu(
+    sample_keys: Tuple[bytes, ...], monkeypatch: MonkeyPatch
+) -> None:
+    # With a single worker there is nothing to gain from a process pool, so none must be started.
+    def no_pool(*args: object) -> None:
+        raise AssertionError("process pool started")
+
+    monkeypatch.setattr(hashdial.os, "cpu_count", lambda: 1)
+    monkeypatch.setattr(hashdial.concurrent.futures, "ProcessPoolExecutor", no_pool)
+
+    keys = sample_keys[:1000]
+    assert hashdial.decide_parallel(keys, 0.25, chunk_size=300) == hashdial.decide_many(
+        keys, 0.25
+    )
+
+
+def test_decide_fixed_width(sample_buffer: bytes) -> None:
+    WIDTH = SAMPLE_KEY_WIDTH
+    buf = sample_buffer[: 1001 * WIDTH]
+    keys = [buf[offset : offset + WIDTH] for offset in range(0, len(buf), WIDTH)]
+
+    for seed in [b"", b"s" * 100]:
+        bitmap = hashdial.decide_fixed_width(buf, WIDTH, 0.25, seed=seed)
+        assert len(bitmap) == 126
+        assert [bool(bitmap[i // 8] >> (i % 8) & 1) for i in range(1008)] == (
+            hashdial.decide_many(keys, 0.25, seed=seed) + [False] * 7
+        )
+
+    assert hashdial.decide_fixed_width(b"", WIDTH, 0.25) == b""
+
+    with pytest.raises(ValueError):
+        hashdial.decide_fixed_width(b"abc", 0, 0.25)
+    with pytest.raises(ValueError):
+        hashdial.decide_fixed_width(b"abc", 2, 0.25)
+    with pytest.raises(ValueError):
+        hashdial.decide_fixed_width(b"abcd", 2, 1.5)
+
+
+def test_decide_fixed_width_distribution(sample_buffer: bytes) -> None:
+    PROBABILITY = 0.25
+    NUM_SAMPLES = 1000
+    WIDTH = SAMPLE_KEY_WIDTH
+
+    bitmap = hashdial.decide_fixed_width(
+        sample_buffer[: NUM_SAMPLES * WIDTH], WIDTH, PROBABILITY
+    )
+    num_true = bin(int.from_bytes(bitmap, "little")).count("1")
+
+    assert PROBABILITY * NUM_SAMPLES * 0.9 < num_true < PROBABILITY * NUM_SAMPLES * 1.1
+
+
+def test_make_decider(sample_keys: Tuple[bytes, ...]) -> None:
+    keys = sample_keys[:1000]
+
+    for probability in [0.0, 1e-300, 0.25, 0.5, 1.0]:
+        for seed in [b"", b"test2"]:
+            decider = hashdial.make_decider(probability, seed=seed)
+            assert [decider(key) for key in keys] == hashdial.decide_many(
+                keys, probability, seed=seed
+            )
+
+    with pytest.raises(ValueError):
+        hashdial.make_decider(-0.5)
+
+
+def test_make_decider_cache(
+    sample_keys: Tuple[bytes, ...], monkeypatch: MonkeyPatch
+) -> None:
+    # Each key is repeated straight away, so its second lookup is a cache hit regardless of which slot it maps to.
+    keys = [key for key in sample_keys[:500] for _ in range(2)]
+    expected = hashdial.decide_many(keys, 0.25, seed=b"test2")
+
+    hash_u64 = hashdial._hash_u64
+    hashed = []  # type: List[bytes]
+
+    def counting_hash_u64(b: bytes, seed: bytes) -> int:
+        hashed.append(b)
+        return hash_u64(b, seed)
+
+    monkeypatch.setattr(hashdial, "_hash_u64", counting_hash_u64)
+
+    decider = hashdial.make_decider(0.25, seed=b"test2", cache_bits=4)
+    assert [decider(key) for key in keys] == expected
+    assert hashed == list(sample_keys[:500])
+
+    # Other bytes-like keys bypass the cache, including unhashable ones.
+    expected_decision = hashdial.decide(b"1", 0.25, seed=b"test2")
+    assert decider(bytearray(b"1")) == expected_decision
+    assert decider(memoryview(bytearray(b"1"))) == expected_decision
+    assert decider(memoryview(b"1")) == expected_decision
 
-def test_range_large_diff() -> None:
     with pytest.raises(ValueError):
-        hashdial.range(b"", 2 ** 63)
+        hashdial.make_decider(0.25, cache_bits=-1)
+
+
+def test_filter_lines() -> None:
+    lines = ["{}\n".format(n).encode("utf-8") for n in range(1000)]
+
+    assert list(hashdial.filter_lines(lines, 0.25, seed=b"test2")) == [
+        line for line in lines if hashdial.decide(line, 0.25, seed=b"test2")
+    ]
+
     with pytest.raises(ValueError):
-        hashdial.range(start=-(2 ** 63), stop=0, key=b"")
+        hashdial.filter_lines(lines, 1.5)
+
+
+def test_u64_threshold() -> None:
+    for probability in [0.0, 1e-300, 0.1, 0.25, 1.0 - 1e-16, 1.0]:
+        threshold = hashdial._u64_threshold(probability)
+        assert not threshold * hashdial._INV_2_64 < probability
+        if threshold > 0:
+            assert (threshold - 1) * hashdial._INV_2_64 < probability
 
+    # Hash values this close to 2 ** 64 round up to 1.0 when converted to float, so even a probability of 1.0 does not
+    # decide them True.
+    assert hashdial._u64_threshold(1.0) < 2 ** 64
 
-def test_select() -> None:
-    NUM_SAMPLES = 10000
 
-    values = {}  # type: Dict[int, int]
+@pytest.mark.parametrize(
+    "choose",
+    [
+        lambda keys: hashdial.range_many(keys, 2, start=-1),
+        lambda keys: [hashdial.range(key, 3 * 2 ** 62) // 2 ** 62 - 1 for key in keys],
+        lambda keys: [hashdial.select(key, [-1, 0, 1]) for key in keys],
+    ],
+    ids=["range", "range_large_diff", "select"],
+)
+def test_three_way_distribution(
+    sample_keys: Tuple[bytes, ...], choose: Callable[[Tuple[bytes, ...]], List[int]]
+) -> None:
+    NUM_SAMPLES = 4000
 
-    for n in range(NUM_SAMPLES):
-        selected = hashdial.select("{}".format(n).encode("utf-8"), [-1, 0, 1])
-        values[selected] = values.get(selected, 0) + 1
+    selections = choose(sample_keys[:NUM_SAMPLES])
+    counts = [selections.count(val) for val in [-1, 0, 1]]
+    # Nothing was chosen outside of the three values.
+    assert sum(counts) == NUM_SAMPLES
+
+    for count in counts:
+        assert_binomial(count, 1 / 3, NUM_SAMPLES)
+
+
+def test_range_seed() -> None:
+    assert hashdial.range(b"t", 2) != hashdial.range(b"t", 2, seed=b"test2")
+
+
+def test_range_stable() -> None:
+    # Changing these values requires a major version bump (see "Determinism across versions").
+    assert hashdial.range(b"hashdial", 1000) == 100
+    assert hashdial.range(b"hashdial", 1000, start=-500, seed=b"seed") == 203
+    assert hashdial.range(b"hashdial", 2 ** 53 - 1) == 905809550725697
+
+
+def test_range_bad_range() -> None:
+    with pytest.raises(ValueError) as exc_info:
+        hashdial.range(b"", 0)
+    assert str(exc_info.value) == "stop (0) must be > start (0)"
+
+    with pytest.raises(ValueError) as exc_info:
+        hashdial.range(b"", -1, start=1)
+    assert str(exc_info.value) == "stop (-1) must be > start (1)"
 
-    assert set(values.keys()) == {-1, 0, 1}
 
-    for val in [-1, 0, 1]:
-        assert values[val] > NUM_SAMPLES * 0.33 * 0.9
-        assert values[val] < NUM_SAMPLES * 0.33 * 1.1
+@pytest.mark.parametrize("start,stop", [(0, 2 ** 63), (-(2 ** 63), 0), (0, 2 ** 64)])
+def test_range_large_diff(start: int, stop: int) -> None:
+    assert start <= hashdial.range(b"", stop, start=start) < stop
+
+
+def test_range_max_diff() -> None:
+    # The full range of the hash is used as-is.
+    assert hashdial.range(b"", 2 ** 64) == hashdial._hash_u64(b"", seed=b"")
+
+    with pytest.raises(ValueError) as exc_info:
+        hashdial.range(b"", 2 ** 64 + 1)
+    assert str(exc_info.value) == "stop-start ({}) must be <= {}".format(
+        2 ** 64 + 1, 2 ** 64
+    )
+
+
+def test_range_many(sample_keys: Tuple[bytes, ...]) -> None:
+    keys = sample_keys[:1000]
+
+    assert hashdial.range_many(keys, 10) == [hashdial.range(key, 10) for key in keys]
+    assert hashdial.range_many(keys, 10, start=-5, seed=b"test2") == [
+        hashdial.range(key, 10, start=-5, seed=b"test2") for key in keys
+    ]
+
+    assert hashdial.range_many(keys, 2 ** 63) == [
+        hashdial.range(key, 2 ** 63) for key in keys
+    ]
+
+    with pytest.raises(ValueError):
+        hashdial.range_many(keys, 0)
 
 
 def test_select_seed() -> None:
     assert hashdial.select(b"t", [0, 1]) != hashdial.select(b"t", [0, 1], seed=b"test2")
 
 
+def test_select_stable() -> None:
+    # Changing these values requires a major version bump (see "Determinism across versions").
+    assert hashdial.select(b"hashdial", "abcdefg") == "a"
+    assert hashdial.select(b"hashdial", "abcdefg", seed=b"seed") == "d"
+
+
+def test_select_large_seq() -> None:
+    seq = range(2 ** 62)
+    assert hashdial.select(b"t", seq) == hashdial.range(b"t", 2 ** 62)
+    assert hashdial.prepare(b"").select(b"t", seq) == hashdial.range(b"t", 2 ** 62)
+
+
 def test_select_empty_seq() -> None:
-    with pytest.raises(ValueError):
+    with pytest.raises(ValueError) as exc_info:
         hashdial.select(b"", [])
+    assert str(exc_info.value) == "non-empty sequence required"
+
+
+def test_prepared_seed(sample_keys: Tuple[bytes, ...]) -> None:
+    keys = sample_keys[:1000]
+
+    for seed in [b"", b"test2", b"s" * 100]:
+        prepared = hashdial.prepare(seed)
+        for key in keys:
+            assert prepared.decide(key, 0.25) == hashdial.decide(key, 0.25, seed=seed)
+            assert prepared.range(key, 10, start=-5) == hashdial.range(
+                key, 10, start=-5, seed=seed
+            )
+            assert prepared.range(key, 2 ** 63) == hashdial.range(key, 2 ** 63, seed=seed)
+            assert prepared.select(key, [0, 1, 2]) == hashdial.select(
+                key, [0, 1, 2], seed=seed
+            )
+
+    prepared = hashdial.prepare(b"")
+    # Kept free of a per-instance __dict__, since its methods are called in tight loops.
+    assert not hasattr(prepared, "__dict__")
+
+    with pytest.raises(ValueError):
+        prepared.decide(b"", 1.5)
+    with pytest.raises(ValueError):
+        prepared.range(b"", 0)
+    with pytest.raises(ValueError):
+        prepared.select(b"", [])